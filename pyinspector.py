@@ -23,34 +23,649 @@ import logging
 import ast
 import bdb
 import copy
+import dis
 import gc
+import hashlib
 import inspect
+import json
+import marshal
+import threading
 import timeit
 import types
 
 from StringIO import StringIO
-from itertools import chain
+from collections import OrderedDict
+from itertools import chain, count
+from timeit import default_timer
 
-DEFAULT_VARS = set(('__builtins__', '__doc__', '__name__', '__package__'))
+# Name of the function which print statements in the traced code are
+# rewritten to call
+PRINT_FUNC_NAME = "__pyinspector_print__"
+# Name which references to sys.stdout in the traced code are rewritten to
+STDOUT_NAME = "__pyinspector_stdout__"
+
+DEFAULT_VARS = set(('__builtins__', '__doc__', '__name__', '__package__', 'print', PRINT_FUNC_NAME, STDOUT_NAME))
 
 # Threshold to prevent infinite loops
 MAX_STEPS = 500
+# When compressing repeated calls, MAX_STEPS limits the number of steps
+# stored, and this limits the total number of steps executed
+MAX_TOTAL_STEPS = 10000
+
+# Threshold to prevent unbounded output, e.g. from a print in a hot loop
+MAX_OUTPUT_BYTES = 10000
+OUTPUT_TRUNCATED_MARKER = "\n...[output truncated]\n"
+
+# Phases of an inspection which are timed, in order
+PHASES = ("compile", "trace", "package_vars", "gc", "timing", "tests")
+# Events counted during an inspection
+EVENT_COUNTS = ("calls", "lines", "returns", "exceptions", "vars_rendered", "output_bytes", "heap_cache_hits",
+                "tests_untraced", "tests_traced", "call_cache_hits", "call_cache_misses", "spliced_steps",
+                "compressed_calls")
+
+# Upper bounds (in seconds) of the phase duration histogram buckets
+PHASE_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# ==== Call trace cache ==== #
+# Maximum number of call trace fragments kept in a CallTraceCache
+MAX_CACHED_CALLS = 1000
+# Values which can form part of a call trace cache key
+FREEZABLE_TYPES = (int, long, float, complex, bool, str, unicode, types.NoneType)
+# Builtins which can be called from a cached function
+PURE_BUILTINS = set((
+    'True', 'False', 'None', 'abs', 'all', 'any', 'bin', 'bool', 'chr', 'cmp',
+    'dict', 'divmod', 'enumerate', 'filter', 'float', 'frozenset', 'hex', 'int',
+    'isinstance', 'len', 'list', 'long', 'map', 'max', 'min', 'oct', 'ord',
+    'pow', 'range', 'reduce', 'repr', 'reversed', 'round', 'set', 'sorted',
+    'str', 'sum', 'tuple', 'unichr', 'unicode', 'xrange', 'zip',
+))
+# Opcodes which mean a function may have side effects, or depend on state
+# which is not part of its cache key
+IMPURE_OPCODES = set(dis.opmap[name] for name in (
+    'STORE_GLOBAL', 'DELETE_GLOBAL', 'LOAD_NAME', 'STORE_NAME', 'DELETE_NAME',
+    'IMPORT_NAME', 'IMPORT_STAR', 'IMPORT_FROM', 'EXEC_STMT', 'PRINT_ITEM',
+    'PRINT_ITEM_TO', 'PRINT_NEWLINE', 'PRINT_NEWLINE_TO', 'PRINT_EXPR',
+    'LOAD_CLOSURE', 'LOAD_DEREF', 'STORE_DEREF', 'BUILD_CLASS', 'LOAD_LOCALS',
+))
+CO_GENERATOR = 0x20
+# ========================== #
+
+# Containers whose own encoding can never change once created
+HEAP_IMMUTABLE_TYPES = (tuple, frozenset)
+
+# Frames of library code (modules defining __all__) and of the helpers in
+# this module called by the traced code (e.g. OutputCapture) are not traced
+def is_untraced_frame(frame):
+    return "__all__" in frame.f_globals or frame.f_globals is globals()
+
+# Bounded buffer holding the output of the traced code. Rather than replacing
+# the process-wide sys.stdout, print statements in the traced code are
+# rewritten to call print_statement (see PrintTransformer), and print_function
+# is injected for code using 'from __future__ import print_function'
+class OutputCapture(object):
+    def __init__(self, max_bytes=None):
+        # MAX_OUTPUT_BYTES is read here, so that it can be configured
+        # after import
+        if max_bytes is None:
+            max_bytes = MAX_OUTPUT_BYTES
+        self.max_bytes = max_bytes
+        self.chunks = []
+        # Number of bytes captured so far
+        self.size = 0
+        self.truncated = False
+        # Output is discarded once capturing is stopped
+        self.active = True
+        self.softspace = False
+        # Threads started by the traced code share the buffer
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        with self.lock:
+            if not self.active or self.truncated:
+                return
+            remaining = self.max_bytes - self.size
+            if len(text) > remaining:
+                text = text[:remaining]
+                self.truncated = True
+            self.chunks.append(text)
+            self.size += len(text)
+            if self.truncated:
+                self.chunks.append(OUTPUT_TRUNCATED_MARKER)
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+    def stop(self):
+        self.active = False
+
+    def flush(self):
+        pass
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def is_stdout(self, dest):
+        return dest is None or dest is self or dest is sys.stdout or dest is sys.__stdout__
+
+    # Replacement for the print statement: print >>dest, *values[,]
+    def print_statement(self, dest, values, newline):
+        if not self.is_stdout(dest):
+            # Printing to an explicit file, e.g. print >>sys.stderr, x
+            for value in values:
+                print >>dest, value,
+            if newline:
+                print >>dest
+            return
+        if not self.active or self.truncated:
+            return
+        for value in values:
+            if self.softspace:
+                self.write(" ")
+            text = value if isinstance(value, basestring) else str(value)
+            self.write(text)
+            # Same rule as the print statement: no space is inserted after a
+            # string ending in whitespace other than ' '
+            self.softspace = not (isinstance(value, basestring) and value[-1:].isspace() and value[-1:] != " ")
+        if newline:
+            self.write("\n")
+            self.softspace = False
+
+    # Replacement for the print function
+    def print_function(self, *values, **kwargs):
+        sep = kwargs.get("sep")
+        end = kwargs.get("end")
+        dest = kwargs.get("file")
+        if sep is None:
+            sep = " "
+        if end is None:
+            end = "\n"
+        text = sep.join([v if isinstance(v, basestring) else str(v) for v in values]) + end
+        if not self.is_stdout(dest):
+            dest.write(text)
+        else:
+            self.softspace = False
+            self.write(text)
+
+# Counts the steps and variables which PyInspector would record when running
+# a test case, without rendering any values. Mirrors the stepping behaviour of
+# PyInspector under bdb, so that untraced test results report the same
+# num_steps and num_vars as traced ones
+class StepCounter(object):
+    def __init__(self, target_func_name):
+        self.target_func_name = target_func_name
+        self.num_steps = 0
+        # Variable names with scope, as keyed in PyInspector.var_dict
+        self.var_names = set()
+        self.scope_stack = []
+        self.botframe = None
+        # Set once tracing would have stopped (i.e. bdb's set_continue)
+        self.done = False
+        self.exception = False
+        self.exceeded_steps = False
+
+    # Evaluates the given code object under the counter, returning its value
+    def run(self, code, global_vars):
+        sys.settrace(self.trace_dispatch)
+        try:
+            return eval(code, global_vars)
+        finally:
+            sys.settrace(None)
+
+    def count_step(self, frame):
+        self.num_steps += 1
+        prefix = ":".join(self.scope_stack) + ":"
+        for name in chain(frame.f_globals, frame.f_locals):
+            if name not in DEFAULT_VARS:
+                self.var_names.add(prefix + name)
+        if self.num_steps > MAX_STEPS:
+            self.exceeded_steps = True
+            self.done = True
+            # Force quit execution
+            raise bdb.BdbQuit
+
+    def trace_dispatch(self, frame, event, arg):
+        if self.done:
+            return None
+        if event == "call":
+            if self.botframe is None:
+                # Frame of the evaluated code itself
+                self.botframe = frame.f_back
+                return self.trace_dispatch
+            # Library code is not traced
+            if is_untraced_frame(frame):
+                return None
+            self.scope_stack.append(frame.f_code.co_name)
+            self.count_step(frame)
+        elif event == "line":
+            self.count_step(frame)
+        elif event == "return":
+            name = frame.f_code.co_name or "<unknown>"
+            if name == "<module>":
+                self.done = True
+                return None
+            self.scope_stack.pop()
+            self.count_step(frame)
+            if name == self.target_func_name and frame.f_back.f_code.co_name == "<module>":
+                self.done = True
+        elif event == "exception":
+            self.count_step(frame)
+            self.exception = True
+            self.done = True
+        return self.trace_dispatch
+
+# Returns a hashable form of the given value if it is immutable (numbers,
+# strings, None, and tuples / frozensets of these), otherwise None
+def freeze_value(val):
+    if type(val) in FREEZABLE_TYPES:
+        return (type(val).__name__, repr(val))
+    if type(val) in (tuple, frozenset):
+        items = [freeze_value(v) for v in val]
+        if None in items:
+            return None
+        if type(val) is frozenset:
+            items.sort()
+        return (type(val).__name__, tuple(items))
+    return None
+
+# Statically checks whether a function's code can have its calls cached.
+# Returns (digest, global_names, line_nums) if so, or None if the code may
+# have side effects or read state other than its arguments and globals
+def analyse_call_code(code):
+    if code.co_flags & CO_GENERATOR or code.co_freevars or code.co_cellvars:
+        return None
+    global_names = set()
+    line_nums = set()
+    code_objs = [code]
+    while code_objs:
+        code_obj = code_objs.pop()
+        for (offset, line_num) in dis.findlinestarts(code_obj):
+            line_nums.add(line_num)
+        for const in code_obj.co_consts:
+            if isinstance(const, types.CodeType):
+                code_objs.append(const)
+        co_code = code_obj.co_code
+        i = 0
+        extended_arg = 0
+        while i < len(co_code):
+            op = ord(co_code[i])
+            if op in IMPURE_OPCODES:
+                return None
+            if op < dis.HAVE_ARGUMENT:
+                i += 1
+                continue
+            arg = ord(co_code[i+1]) + ord(co_code[i+2]) * 256 + extended_arg
+            extended_arg = 0
+            i += 3
+            if op == dis.EXTENDED_ARG:
+                extended_arg = arg * 65536
+            elif op == dis.opmap['LOAD_GLOBAL']:
+                global_names.add(code_obj.co_names[arg])
+    digest = hashlib.sha1(marshal.dumps(code)).hexdigest()
+    return (digest, global_names, sorted(line_nums))
+
+# Stores the steps recorded for calls to pure functions, so that later calls
+# with the same code, arguments and globals (in the same or a later
+# inspection) can be spliced into the trace rather than traced again. Safe to
+# share between inspections running in different threads
+class CallTraceCache(object):
+    def __init__(self, max_entries=MAX_CACHED_CALLS):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.fragments = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            fragment = self.fragments.pop(key, None)
+            if fragment is not None:
+                # Most recently used entries are kept at the end
+                self.fragments[key] = fragment
+            return fragment
+
+    def put(self, key, fragment):
+        with self.lock:
+            self.fragments.pop(key, None)
+            self.fragments[key] = fragment
+            while len(self.fragments) > self.max_entries:
+                self.fragments.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.fragments.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.fragments.clear()
+
+    def __len__(self):
+        return len(self.fragments)
+
+# Default cache shared by all inspections
+CALL_TRACE_CACHE = CallTraceCache()
+
+# Aggregates the metrics of many inspections into counters and phase duration
+# histograms, which can be exported as Prometheus text or JSON. Safe to share
+# between inspections running in different threads
+class InspectorMetrics(object):
+    def __init__(self, buckets=PHASE_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.inspections = 0
+            self.inspections_with_errors = 0
+            self.counters = dict((event, 0) for event in EVENT_COUNTS)
+            # phase -> {"buckets" : [count per bucket, ..., +Inf], "sum", "count"}
+            self.histograms = {}
+
+    # Adds the metrics of a single inspection (PyInspector.metrics)
+    def record(self, metrics, has_errors=False):
+        with self.lock:
+            self.inspections += 1
+            if has_errors:
+                self.inspections_with_errors += 1
+            for (event, count) in metrics["counts"].iteritems():
+                self.counters[event] = self.counters.get(event, 0) + count
+            for (phase, seconds) in metrics["phases"].iteritems():
+                if phase not in self.histograms:
+                    self.histograms[phase] = {
+                        "buckets" : [0] * (len(self.buckets) + 1),
+                        "sum" : 0.0,
+                        "count" : 0,
+                    }
+                histogram = self.histograms[phase]
+                index = len(self.buckets)
+                for (i, bound) in enumerate(self.buckets):
+                    if seconds <= bound:
+                        index = i
+                        break
+                histogram["buckets"][index] += 1
+                histogram["sum"] += seconds
+                histogram["count"] += 1
+
+    def to_dict(self):
+        with self.lock:
+            phases = {}
+            for (phase, histogram) in self.histograms.iteritems():
+                labels = ["%g" % bound for bound in self.buckets] + ["+Inf"]
+                phases[phase] = {
+                    "buckets" : dict(zip(labels, histogram["buckets"])),
+                    "sum" : histogram["sum"],
+                    "count" : histogram["count"],
+                }
+            return {
+                "inspections" : self.inspections,
+                "inspections_with_errors" : self.inspections_with_errors,
+                "counters" : dict(self.counters),
+                "phases" : phases,
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    # Prometheus text exposition format
+    def to_prometheus(self):
+        with self.lock:
+            lines = [
+                "# HELP pyinspector_inspections_total Number of inspections run.",
+                "# TYPE pyinspector_inspections_total counter",
+                "pyinspector_inspections_total %d" % self.inspections,
+                "# HELP pyinspector_inspection_errors_total Number of inspections which reported errors.",
+                "# TYPE pyinspector_inspection_errors_total counter",
+                "pyinspector_inspection_errors_total %d" % self.inspections_with_errors,
+                "# HELP pyinspector_events_total Number of events handled during inspections.",
+                "# TYPE pyinspector_events_total counter",
+            ]
+            for event in sorted(self.counters):
+                lines.append('pyinspector_events_total{event="%s"} %d' % (event, self.counters[event]))
+            lines.append("# HELP pyinspector_phase_seconds Time spent in each phase of an inspection.")
+            lines.append("# TYPE pyinspector_phase_seconds histogram")
+            for phase in sorted(self.histograms):
+                histogram = self.histograms[phase]
+                cumulative = 0
+                for (i, bound) in enumerate(self.buckets):
+                    cumulative += histogram["buckets"][i]
+                    lines.append('pyinspector_phase_seconds_bucket{phase="%s",le="%g"} %d' % (phase, bound, cumulative))
+                cumulative += histogram["buckets"][-1]
+                lines.append('pyinspector_phase_seconds_bucket{phase="%s",le="+Inf"} %d' % (phase, cumulative))
+                lines.append('pyinspector_phase_seconds_sum{phase="%s"} %r' % (phase, histogram["sum"]))
+                lines.append('pyinspector_phase_seconds_count{phase="%s"} %d' % (phase, histogram["count"]))
+            return "\n".join(lines) + "\n"
+
+    # Writes the metrics to the given file, as "prometheus" or "json"
+    def export(self, filepath, fmt="prometheus"):
+        if fmt == "prometheus":
+            text = self.to_prometheus()
+        elif fmt == "json":
+            text = self.to_json()
+        else:
+            raise ValueError("Unknown metrics format: " + str(fmt))
+        with open(filepath, "w") as metrics_file:
+            metrics_file.write(text)
+
+# Default registry which all inspections are recorded in
+METRICS = InspectorMetrics()
+
+# Rewrites print statements into calls to PRINT_FUNC_NAME, and references to
+# sys.stdout into STDOUT_NAME, so that output can be captured without
+# touching sys.stdout
+class PrintTransformer(ast.NodeTransformer):
+    def visit_Print(self, node):
+        self.generic_visit(node)
+        dest = node.dest or ast.Name(id="None", ctx=ast.Load())
+        call = ast.Call(
+            func=ast.Name(id=PRINT_FUNC_NAME, ctx=ast.Load()),
+            args=[dest, ast.List(elts=node.values, ctx=ast.Load()), ast.Num(n=int(node.nl))],
+            keywords=[], starargs=None, kwargs=None)
+        new_node = ast.copy_location(ast.Expr(value=call), node)
+        return ast.fix_missing_locations(new_node)
+
+    # sys.stdout, e.g. sys.stdout.write(text)
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == "sys" and node.attr == "stdout" and isinstance(node.ctx, ast.Load):
+            return ast.copy_location(ast.Name(id=STDOUT_NAME, ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+    # from sys import stdout [as name]
+    def visit_ImportFrom(self, node):
+        if node.module != "sys" or node.level:
+            return node
+        out = []
+        names = []
+        for alias in node.names:
+            if alias.name == "stdout":
+                assign = ast.Assign(targets=[ast.Name(id=alias.asname or alias.name, ctx=ast.Store())],
+                                    value=ast.Name(id=STDOUT_NAME, ctx=ast.Load()))
+                out.append(ast.fix_missing_locations(ast.copy_location(assign, node)))
+            else:
+                names.append(alias)
+        if names:
+            node.names = names
+            out.insert(0, node)
+        return out
+
+# Compiles the given code string, with print statements rewritten to be
+# captured by OutputCapture
+def compile_traced_code(code_str):
+    tree = PrintTransformer().visit(ast.parse(code_str, "<string>"))
+    return compile(tree, "<string>", mode="exec")
+
+def exec_code(code, namespace):
+    exec code in namespace
+
+# Copies a variable's value into a step, sharing {memo} between the values of
+# the step. Values which cannot be copied (e.g. threads and locks) are stored
+# as their str
+def copy_step_value(val, memo):
+    try:
+        return copy.deepcopy(val, memo)
+    except Exception:
+        # The memo may hold partial copies made before the failure, which
+        # must not be reused for later values
+        memo.clear()
+        return str(val)
+
+# Inspections whose code may start threads, keyed by the id of the namespace
+# the code is run in. Installed as the threading trace hook while not empty
+THREAD_INSPECTORS = {}
+THREAD_INSPECTORS_LOCK = threading.Lock()
+# Threading trace hook set by the host before the first inspection registered,
+# which is restored once the last one finishes, and used for other threads
+HOST_THREAD_HOOK = None
+
+def register_thread_inspector(inspector, namespace):
+    global HOST_THREAD_HOOK
+    with THREAD_INSPECTORS_LOCK:
+        if not THREAD_INSPECTORS:
+            HOST_THREAD_HOOK = threading._trace_hook
+            threading.settrace(trace_new_thread)
+        THREAD_INSPECTORS[id(namespace)] = inspector
+
+def unregister_thread_inspector(namespace):
+    global HOST_THREAD_HOOK
+    with THREAD_INSPECTORS_LOCK:
+        THREAD_INSPECTORS.pop(id(namespace), None)
+        if not THREAD_INSPECTORS:
+            # Unless the host has set another hook in the meantime
+            if threading._trace_hook is trace_new_thread:
+                threading.settrace(HOST_THREAD_HOOK)
+            HOST_THREAD_HOOK = None
+
+# Global trace function for new threads. The first event in a thread is the
+# call to its run method, from which the namespace of its target is found, and
+# the thread handed to the inspection running that namespace (if any). Other
+# threads are traced by the host's hook, as they would be without inspections
+def trace_new_thread(frame, event, arg):
+    thread = frame.f_locals.get("self")
+    inspector = None
+    if isinstance(thread, threading.Thread):
+        target = getattr(thread, "_Thread__target", None)
+        if target is None:
+            # Thread subclass overriding run
+            namespace = frame.f_globals
+        else:
+            namespace = getattr(getattr(target, "im_func", target), "func_globals", None)
+        inspector = THREAD_INSPECTORS.get(id(namespace))
+    if inspector is None:
+        host_hook = HOST_THREAD_HOOK
+        sys.settrace(host_hook)
+        if host_hook is None:
+            return None
+        return host_hook(frame, event, arg)
+    return inspector.start_thread_trace(frame, event, arg)
 
 class PyInspector(bdb.Bdb):
-    def __init__(self, code_str_in, extra_line_data={}, test_data={"tests":[],"func_name":None}):
+    def __init__(self, code_str_in, extra_line_data={}, test_data={"tests":[],"func_name":None}, capture_heap=False, metrics_registry=METRICS, trace_tests="failures", call_cache=CALL_TRACE_CACHE, compress_calls=False):
         bdb.Bdb.__init__(self)
+        inspection_start = default_timer()
         # Additional line data such as expression trees (only able to get from
         # AST parser library)
         self.extra_line_data = extra_line_data
 
+        # ==== Heap capture ==== #
+        # When enabled, compound values (lists, dicts, instances, ...) are
+        # stored once in an object table keyed by id, and variables store
+        # ["REF", id] references to them instead of str(val)
+        self.capture_heap = capture_heap
+        # Object table: id -> list of [step, encoding] versions. A new version
+        # is only added when the object's encoding changes (i.e. on mutation)
+        self.heap = {}
+        # Strong references to captured objects during tracing, so that ids
+        # cannot be recycled by new objects mid-trace
+        self.heap_objects = {}
+        # References held by each object when it was last encoded. An object
+        # is only re-encoded once these change, i.e. once it is mutated
+        self.heap_refs = {}
+        # ====================== #
+
+        # ==== Call trace cache ==== #
+        # Calls to pure functions are recorded in {call_cache}, and spliced
+        # into the trace when called again with the same arguments and globals.
+        # None disables caching
+        self.call_cache = call_cache
+        # Results of analyse_call_code, keyed by code object
+        self.call_code_infos = {}
+        # Calls currently being recorded (innermost last), and the steps
+        # recorded for them since the outermost call began
+        self.call_recorders = []
+        self.call_step_log = []
+        # Frame of the call currently being run untraced after being spliced
+        self.spliced_frame = None
+        self.spliced_key = None
+        self.spliced_fragment = None
+        # ========================== #
+
+        # ==== Call tree ==== #
+        # When enabled, a call identical to an earlier one (same function,
+        # arguments and resulting steps) is stored in exec_steps as a single
+        # CALL_REF step referencing the earlier call's node
+        self.compress_calls = compress_calls
+        # Nodes of the call tree, indexed by id, in the form
+        # {"func", "args", "num_steps", "start", "length", "depth",
+        #  "output_offset", "first_step", "thread", "children"}, where start
+        # and length give the node's steps in the steps of its thread (see
+        # steps_by_thread), and depth the length of its caller's scope
+        self.call_nodes = []
+        # Node ids of the calls made from the top level, in order
+        self.call_tree = []
+        # Node id for each call signature
+        self.call_signatures = {}
+        # Calls in progress (innermost last)
+        self.call_stack = []
+        # Tokens identifying the steps stored since the outermost call in
+        # progress began, with each completed call collapsed to one token
+        self.call_tokens = []
+        # =================== #
+
+        # ==== Threads ==== #
+        # Threads started by the traced code are traced by a copy of the
+        # inspector (see start_thread_trace) which shares the variable traces,
+        # heap and output, but has its own scope stack, steps and calls in
+        # progress. Steps are numbered in one global order by {step_counter},
+        # and the steps of all threads are merged into exec_steps at the end
+        self.thread_name = threading.current_thread().name.replace(":", "_")
+        self.thread_tracers = []
+        # Steps of each thread before merging, keyed by thread name
+        self.steps_by_thread = {}
+        self.step_counter = count(1)
+        # Number of steps added by this thread
+        self.thread_step_count = 0
+        self.tracing_threads = False
+        self.main_tracer = self
+        # Guards the state shared between threads which is not updated at
+        # every step (thread names and the call tree)
+        self.thread_lock = threading.Lock()
+        # ================= #
+
+        # ==== Instrumentation ==== #
+        # Time spent in each phase (seconds) and counts of events for this
+        # inspection. Also added to {metrics_registry}, unless it is None
+        self.metrics = {
+            "phases" : {},
+            "counts" : dict((event, 0) for event in EVENT_COUNTS),
+        }
+        self.metrics_registry = metrics_registry
+        # ========================= #
+
         self.has_errors = False
         self.errors = []
 
         # ==== Testing ==== #
         self.test_results = []
         self.all_tests_passed = False
+        self.untraced_result = None
         self.testing = False
         self.progress = {"num_steps": None, "num_vars" : None}
+        # Which test cases are run under the tracer: "all", "failures", or a
+        # list of test indices (failing tests are always traced). Other tests
+        # are run untraced, only counting steps and variables
+        if trace_tests not in ("all", "failures") and not isinstance(trace_tests, (list, tuple, set)):
+            raise ValueError("trace_tests must be 'all', 'failures' or a list of test indices")
+        self.trace_tests = trace_tests
         # ================= #
 
         self.debug = False
@@ -85,64 +700,97 @@ class PyInspector(bdb.Bdb):
         self.time_taken = None
 
         # Create code object from input code string
+        phase_start = default_timer()
         try:
-            code_in = compile(code_str_in, "<string>", mode="exec")
+            code_in = compile_traced_code(code_str_in)
         except SyntaxError as e:
             self.add_error(e.args[0], e.lineno,0,e.lineno,999)
+            self.end_phase("compile", phase_start)
+            self.finish_metrics(inspection_start)
             return
         except Exception as e:
             self.add_error(str(e), 0,0,0,0)
+            self.end_phase("compile", phase_start)
+            self.finish_metrics(inspection_start)
             return
+        phase_start = self.end_phase("compile", phase_start)
+
+        # Capture code output, scoped to the traced code's namespace
+        self.output_capture = OutputCapture()
 
         # Set local and global namespaces
-        self.global_vars = {"__name__" : "__main__"}
+        self.global_vars = self.get_initial_globals(self.output_capture)
         self.local_vars = self.global_vars
 
-        # Catch stdout to capture code output
-        sys.stdout = mystdout = StringIO()
         # Debug IO object to capture debug output
         self.debug_out = StringIO()
         # Backup debugger, for surgical / quick debugging
         self.force_debug = StringIO()
+        namespace = self.global_vars
+        register_thread_inspector(self, namespace)
+        self.tracing_threads = True
         try:
             self.run(code_in, self.global_vars, self.local_vars)
-            # Reset stdout
-            sys.stdout = sys.__stdout__
         except NameError as e:
-            # Reset stdout
-            sys.stdout = sys.__stdout__
             pass
 
         except Exception as e:
-            # Reset stdout
-            sys.stdout = sys.__stdout__
             traceback.print_exc()
             self.add_error(str(e), self.lineno, 0, self.lineno, 999)
             print("Error in PyInspector base code: " + str(e))
 
-        self.code_output = mystdout.getvalue()
-
-        # Set variable trace history - this will be returned to the user
-        self.trace_history = self.package_vars()
+        # Threads still running after the code has finished are not traced
+        self.tracing_threads = False
+        unregister_thread_inspector(namespace)
+        self.merge_thread_steps()
+        self.code_output = self.output_capture.getvalue()
+        # Output from the timing run and tests is not reported
+        self.output_capture.stop()
+        # Calls left in progress (e.g. after an error) are neither cached nor
+        # compressed
+        self.abort_call_recording()
+        self.call_stack = []
+        self.call_tokens = []
+        self.metrics["counts"]["output_bytes"] = self.output_capture.size
+        phase_start = self.end_phase("trace", phase_start)
+
+        # Object ids are recorded in the heap, objects no longer needed
+        self.heap_objects = {}
+        self.heap_refs = {}
+
+        # Set variable trace history - this will be returned to the user.
+        # Like exec_step_linenums, traces are indexed by step in exec_steps,
+        # so are compressed along with the steps (see expand_trace_history)
+        self.var_dict = self.build_var_dict(self.exec_steps)
+        self.exec_step_linenums = [step["line_num"] for step in self.exec_steps]
+        self.trace_history = self.package_vars(self.var_dict, len(self.exec_steps))
+        phase_start = self.end_phase("package_vars", phase_start)
 
         #garbage collection
         gc.collect()
+        phase_start = self.end_phase("gc", phase_start)
 
         # Only get run time if no errors are reported
         if not self.has_errors:
-            sys.stdout = StringIO()
             try:
-                # Get time taken to compute (convert to milliseconds)
-                self.time_taken = (timeit.timeit(code_str_in, number=10) / 10.0) * 1000
+                # Get time taken to compute (convert to milliseconds), running
+                # in a fresh namespace each time
+                discard_output = OutputCapture()
+                discard_output.stop()
+                timer = timeit.Timer(lambda: exec_code(code_in, self.get_initial_globals(discard_output)))
+                self.time_taken = (timer.timeit(number=10) / 10.0) * 1000
             except:
                 # Let the tracing handle exception reporting
                 pass
+            phase_start = self.end_phase("timing", phase_start)
 
             # Run code through each test
             self.all_tests_passed = True
             tests = test_data["tests"]
             self.target_func_name = test_data["func_name"]
             self.testing = True
+            # Test calls run so far, in the namespace shared by the tests
+            test_calls = []
             for self.test_index in xrange(0, len(tests)):
                 # ast.literal_eval transforms a list in string form to list form
                 inputs = ast.literal_eval(tests[self.test_index]["inputs"])
@@ -152,47 +800,95 @@ class PyInspector(bdb.Bdb):
                 self.current_outputs = outputs
 
                 # Run code with appended test assignment and variables
-                test_code = "\n" + self.target_func_name+"("
+                test_call = self.target_func_name+"("
                 for input_data in inputs:
-                    test_code += self.get_test_input_assignment(input_data) + ","
+                    test_call += self.get_test_input_assignment(input_data) + ","
                 # Remove last appended comma
-                test_code = test_code[:-1] + ")\n"
+                test_call = test_call[:-1] + ")"
+                test_code = "\n" + test_call + "\n"
                 self.debug_out.write("TEST CODE:\n"+code_str_in+test_code+"\n")
                 try:
                     # Reset scope stack, var names and step num
                     self.exec_step_num = 0
+                    self.step_counter = count(1)
+                    self.finished_tracing = False
                     self.scope_stack = []
                     self.var_dict = {}
 
-                    # Now perform the test using the generated globals and locals
-                    self.run(test_code, self.global_vars, self.local_vars)
+                    counter = None
+                    self.untraced_result = None
+                    test_namespace = namespace
+                    if not self.should_trace_test(self.test_index):
+                        counter = self.run_untraced_test(test_call)
+                        if counter is None:
+                            # The test has already run in the shared
+                            # namespace, so is traced in a copy of its state
+                            # from before the test, to avoid repeating side
+                            # effects
+                            test_namespace = self.get_test_namespace(code_in, test_calls)
+                    test_calls.append(test_call)
+
+                    if counter is not None:
+                        num_steps = counter.num_steps
+                        num_vars = len(counter.var_names)
+                    else:
+                        # Now perform the test using the generated globals and locals
+                        self.metrics["counts"]["tests_traced"] += 1
+                        try:
+                            self.run(test_code, test_namespace, test_namespace)
+                        finally:
+                            self.global_vars = self.local_vars = namespace
+                        num_steps = self.exec_step_num
+                        num_vars = len(self.var_dict)
 
                     # Only save progress for the first test data
                     if self.test_index == 0:
-                        self.progress["num_steps"] = self.exec_step_num
-                        self.progress["num_vars"] = len(self.var_dict)
+                        self.progress["num_steps"] = num_steps
+                        self.progress["num_vars"] = num_vars
 
                 except KeyError as e:
-                    sys.stdout = sys.__stdout__
                     print("KeyError in test case")
                     break
 
                 except NameError as e:
-                    sys.stdout = sys.__stdout__
                     print("NameError in test case")
                     break
 
                 except Exception as e:
-                    sys.stdout = sys.__stdout__
                     print("Exception in test case: " + str(e))
                     break
+            self.end_phase("tests", phase_start)
+
+        self.finish_metrics(inspection_start)
 
-        sys.stdout = sys.__stdout__
         print(self.force_debug.getvalue())
 
         if self.debug:
             logging.debug(self.debug_out.getvalue())
 
+    # Adds the time since {start} to the given phase, returning the current time
+    def end_phase(self, phase, start):
+        now = default_timer()
+        phases = self.metrics["phases"]
+        phases[phase] = phases.get(phase, 0.0) + (now - start)
+        return now
+
+    # Sets the total time of the inspection and adds its metrics to the registry
+    def finish_metrics(self, inspection_start):
+        self.metrics["phases"]["total"] = default_timer() - inspection_start
+        if self.metrics_registry is not None:
+            self.metrics_registry.record(self.metrics, self.has_errors)
+
+    # Returns a new global namespace for running the code in, with output
+    # redirected to the given OutputCapture
+    def get_initial_globals(self, output_capture):
+        return {
+            "__name__" : "__main__",
+            PRINT_FUNC_NAME : output_capture.print_statement,
+            STDOUT_NAME : output_capture,
+            "print" : output_capture.print_function,
+        }
+
     # Strip the given var dict of the default in-built vars
     def get_filtered_vars(self, old_vars):
         new_vars = {}
@@ -209,6 +905,73 @@ class PyInspector(bdb.Bdb):
     def get_trace_vals(self):
         return self.trace_history, self.exec_steps, self.code_output, self.time_taken
 
+    # Returns the call tree (node ids of the top level calls) and the list of
+    # call nodes (only populated if compress_calls is set)
+    def get_call_tree(self):
+        return self.call_tree, self.call_nodes
+
+    # Returns the execution steps with any CALL_REF steps expanded in place,
+    # i.e. exec_steps as they would be without compress_calls
+    def expand_steps(self):
+        out = []
+        for step in self.exec_steps:
+            if step["type"] == "CALL_REF":
+                out.extend(self.expand_call_node(step))
+            else:
+                out.append(step)
+        return out
+
+    # Returns the trace history with repeated calls expanded, i.e. indexed by
+    # step in expand_steps() rather than in exec_steps
+    def expand_trace_history(self):
+        steps = self.expand_steps()
+        return self.package_vars(self.build_var_dict(steps), len(steps))
+
+    # Returns the steps of the call node referenced by the given CALL_REF
+    # step, as called from the step's scope and thread, with its step number
+    # and output offset
+    def expand_call_node(self, ref):
+        node = self.call_nodes[ref["node"]]
+        depth = node["depth"]
+        offset_delta = ref["output_offset"] - node["output_offset"]
+        step_delta = ref["step_num"] - node["first_step"]
+        out = []
+        thread_steps = self.steps_by_thread[node["thread"]]
+        for step in thread_steps[node["start"]:node["start"] + node["length"]]:
+            step = dict(step)
+            step["scope"] = ref["scope"] + step["scope"][depth:]
+            step["output_offset"] += offset_delta
+            step["step_num"] += step_delta
+            step["thread"] = ref["thread"]
+            if step["type"] == "CALL_REF":
+                out.extend(self.expand_call_node(step))
+                continue
+            prefix = ":".join(step["scope"]) + ":"
+            step["active_vars"] = [{
+                "var_id" : prefix + var_data["var_id"].split(":")[-1],
+                "var_value" : copy.deepcopy(var_data["var_value"]),
+                "trace_value" : var_data["trace_value"],
+            } for var_data in step["active_vars"]]
+            step["extra_line_data"] = copy.deepcopy(step["extra_line_data"])
+            out.append(step)
+        return out
+
+    # Returns the heap object table (only populated if capture_heap is set)
+    # in the form {obj_id : [[step, encoding], ...]}
+    def get_heap_vals(self):
+        return self.heap
+
+    # Returns the state of the heap at the given execution step (1-based), in
+    # the form {obj_id : encoding}
+    def get_heap_at_step(self, step):
+        out = {}
+        for (obj_id, versions) in self.heap.iteritems():
+            for (version_step, encoding) in versions:
+                if version_step > step:
+                    break
+                out[obj_id] = encoding
+        return out
+
     # Helper function returning a dict representing an error
     # Cloned from TreeChecker class
     #
@@ -231,14 +994,31 @@ class PyInspector(bdb.Bdb):
         }
         self.errors.append(out)
 
+    # Builds the trace history of each variable from the given steps: its
+    # trace value at each step where it is active, "unassigned" before it is
+    # first active, and its last value at other steps
+    def build_var_dict(self, steps):
+        var_dict = {}
+        for (i, step) in enumerate(steps):
+            for var_data in step.get("active_vars", ()):
+                trace_val = var_data["trace_value"]
+                trace = var_dict.get(var_data["var_id"])
+                if trace is None:
+                    trace = var_dict[var_data["var_id"]] = ["unassigned"] * i
+                else:
+                    trace.extend([trace[-1]] * (i - len(trace)))
+                trace.append(trace_val)
+        return var_dict
+
     # Packages the var_dicts into a list of inidividual dicts in the form:
     # [{"name" : "x", "trace" : ['unassigned','1','2']}]
-    def package_vars(self):
+    # with the traces in {var_dict} padded to {num_steps}
+    def package_vars(self, var_dict, num_steps):
         out = {}
-        for (k, v) in self.var_dict.iteritems():
+        for (k, v) in var_dict.iteritems():
             # Ensure that all variables are padded with values on the end
             last_val = v[-1]
-            for i in range(len(v), self.exec_step_num):
+            for i in range(len(v), num_steps):
                 v.append(last_val)
 
             # Obtain scope from name, ignore last item as the actual name
@@ -413,58 +1193,223 @@ class PyInspector(bdb.Bdb):
         self.evaluate_node(line_data)
         return line_data
 
+    #============ Heap Capture Methods ==============#
+    # Returns the marker used for values which are never expanded, or None
+    def get_value_marker(self, val):
+        if hasattr(val, '__call__'):
+            return "FUNCTION"
+        elif isinstance(val, types.ModuleType):
+            return "MODULE"
+        elif isinstance(val, types.ClassType):
+            return "CLASS"
+        return None
+
+    def is_heap_object(self, val):
+        if isinstance(val, (list, tuple, set, frozenset, dict, types.InstanceType)):
+            return True
+        # New-style class instances
+        return hasattr(val, '__dict__') and not isinstance(val, type)
+
+    # Encodes a value held by a variable: primitives are stored as before,
+    # compound values are added to the heap and referenced by id
+    def encode_heap_value(self, val, visited):
+        if not self.is_heap_object(val):
+            return str(val)
+        self.add_heap_object(val, visited)
+        return ["REF", id(val)]
+
+    # Encodes a value held inside a heap object
+    def encode_heap_element(self, val, visited):
+        marker = self.get_value_marker(val)
+        if marker is not None:
+            return marker
+        if not self.is_heap_object(val):
+            return repr(val)
+        self.add_heap_object(val, visited)
+        return ["REF", id(val)]
+
+    # Returns the objects referenced by a heap object, in the order they are
+    # encoded in. These are compared by identity to detect mutation
+    def get_heap_refs(self, obj):
+        if isinstance(obj, dict):
+            return list(chain.from_iterable(obj.iteritems()))
+        elif isinstance(obj, (list, set)):
+            return list(obj)
+        return [obj.__class__] + list(chain.from_iterable(sorted(obj.__dict__.iteritems())))
+
+    # Adds (or updates) an object and everything reachable from it in the
+    # heap. {visited} holds the ids already processed for the current step, so
+    # that shared references are only encoded once per step
+    def add_heap_object(self, obj, visited):
+        obj_id = id(obj)
+        if obj_id in visited:
+            return
+        visited.add(obj_id)
+
+        versions = self.heap.get(obj_id)
+        if versions is not None:
+            if isinstance(obj, HEAP_IMMUTABLE_TYPES):
+                refs = obj
+            else:
+                refs = self.get_heap_refs(obj)
+                old_refs = self.heap_refs[obj_id]
+                if len(refs) != len(old_refs) or any(a is not b for (a, b) in zip(refs, old_refs)):
+                    refs = None
+            if refs is not None:
+                # Encoding cannot have changed, but its elements may have
+                self.metrics["counts"]["heap_cache_hits"] += 1
+                for elem in refs:
+                    if self.get_value_marker(elem) is None and self.is_heap_object(elem):
+                        self.add_heap_object(elem, visited)
+                return
+
+        if isinstance(obj, list):
+            encoding = ["LIST"] + [self.encode_heap_element(e, visited) for e in obj]
+        elif isinstance(obj, tuple):
+            encoding = ["TUPLE"] + [self.encode_heap_element(e, visited) for e in obj]
+        elif isinstance(obj, (set, frozenset)):
+            encoding = ["SET"] + [self.encode_heap_element(e, visited) for e in obj]
+        elif isinstance(obj, dict):
+            encoding = ["DICT"] + [[self.encode_heap_element(k, visited), self.encode_heap_element(v, visited)] for (k, v) in obj.iteritems()]
+        else:
+            encoding = ["INSTANCE", obj.__class__.__name__]
+            for (k, v) in sorted(obj.__dict__.iteritems()):
+                encoding.append([k, self.encode_heap_element(v, visited)])
+
+        if not isinstance(obj, HEAP_IMMUTABLE_TYPES):
+            self.heap_refs[obj_id] = self.get_heap_refs(obj)
+        if versions is None:
+            self.heap[obj_id] = [[self.exec_step_num, encoding]]
+            self.heap_objects[obj_id] = obj
+        elif versions[-1][1] != encoding:
+            # Object has been mutated since it was last encoded
+            versions.append([self.exec_step_num, encoding])
+
+    # Maps functions, modules, classes (and instances, unless capturing the
+    # heap) to the value shown for them
+    def get_display_value(self, val, heap_mode):
+        # If variable refers to a function, module or class, just put
+        # 'FUNCTION', 'MODULE' or 'CLASS'
+        marker = self.get_value_marker(val)
+        if marker is not None:
+            return marker
+        elif isinstance(val, types.InstanceType) and not heap_mode:
+            return "INSTANCE"
+        return val
+
+    # Sets the value of the variable at the current step in its trace history
+    def add_var_trace(self, varname, trace_val):
+        # New variable
+        if varname not in self.var_dict:
+            self.var_dict[varname] = []
+            for i in range(0, self.exec_step_num-1):
+                self.var_dict[varname].append("unassigned")
+            self.var_dict[varname].append(trace_val)
+        # Existing variable
+        else:
+            last_val = self.var_dict[varname][-1]
+            for i in range(len(self.var_dict[varname]), self.exec_step_num-1):
+                self.var_dict[varname].append(last_val)
+            self.var_dict[varname].append(trace_val)
+
+    # If steps exceeds the max_steps threshold, then exit tracing
+    def check_step_limit(self, current_line):
+        if self.compress_calls and not self.testing:
+            if self.get_num_stored_steps() > MAX_STEPS:
+                max_steps = MAX_STEPS
+            elif self.exec_step_num > MAX_TOTAL_STEPS:
+                max_steps = MAX_TOTAL_STEPS
+            else:
+                return
+        elif self.exec_step_num > MAX_STEPS:
+            max_steps = MAX_STEPS
+        else:
+            return
+        # Reported once, by whichever thread reaches the limit first
+        if not self.main_tracer.finished_tracing:
+            self.main_tracer.finished_tracing = True
+            self.add_error("Your code has too many steps (> "+ str(max_steps) +")", current_line, 1, current_line, 999)
+        # Force quit execution
+        raise bdb.BdbQuit
+
+    # Returns the number of steps stored so far, by all threads
+    def get_num_stored_steps(self):
+        main_tracer = self.main_tracer
+        return len(main_tracer.exec_steps) + sum(len(tracer.exec_steps) for tracer in main_tracer.thread_tracers)
+
+    # Adds a step to exec_steps. {step_vars} holds (name, type name, trace
+    # value) for each active variable, identifying the step's content
+    def add_exec_step(self, step, step_vars):
+        self.exec_steps.append(step)
+        if self.call_stack:
+            content = (step["type"], step["line_num"], sorted(step_vars), repr(step["extra_line_data"]))
+            self.call_tokens.append(("STEP", hashlib.sha1(repr(content)).digest(), step["output_offset"]))
+
     def process_vars(self, frame):
         self.global_vars = frame.f_globals
         self.local_vars = frame.f_locals
 
-        # Increment execution step and append to execution linenums list
-        self.exec_step_num += 1
+        # Take the next step number (shared by all threads)
+        self.exec_step_num = next(self.step_counter)
+        self.thread_step_count += 1
 
         current_line = frame.f_lineno
         self.lineno = current_line
-        self.exec_step_linenums.append(current_line)
 
         global_vars = self.get_filtered_vars(frame.f_globals)
         local_vars = self.get_filtered_vars(frame.f_locals)
         caller_name = frame.f_code.co_name
 
         all_vars = dict(chain(global_vars.items(), local_vars.items()))
+        self.metrics["counts"]["vars_rendered"] += len(all_vars)
 
         # Active variables for current step in execution
         self.current_step["active_vars"] = []
 
-        # Iterate through locals and globals, adding new vars to trace_out
-        # For existing variables, update trace values
-        for (varname, val) in all_vars.iteritems():
+        # Heap objects are not needed for tests, only the return values
+        heap_mode = self.capture_heap and not self.testing
+        # Ids of heap objects already encoded during this step
+        heap_visited = set()
+        # Deepcopy memo shared by the values of this step
+        memo = {}
+
+        # Trace values of local variables, if recording calls for the cache
+        recorded_locals = [] if self.call_recorders and not self.testing else None
+        # Content of the step, if it may be part of a compressed call
+        step_vars = [] if self.call_stack and not self.testing else None
+
+        # Iterate through locals and globals. When testing, trace values are
+        # added to var_dict here. Otherwise each value is read once, into the
+        # step, and var_dict is built from the steps once tracing ends (see
+        # build_var_dict), as other threads may change values in between
+        for (name, val) in all_vars.iteritems():
             # Add scope to variable name
-            varname = ":".join(self.scope_stack) + ":" + varname
-
-            # If variable refers to a function, just print '(function)'
-            if hasattr(val, '__call__'):
-                val = "FUNCTION"
-            elif isinstance(val, types.ModuleType): # If value is a module, just put 'MODULE'
-                val = "MODULE"
-            elif isinstance(val, types.ClassType):
-                val = "CLASS"
-            elif isinstance(val, types.InstanceType):
-                val = "INSTANCE"
-            # New variable
-            if varname not in self.var_dict.keys():
-                self.var_dict[varname] = []
-                for i in range(0, self.exec_step_num-1):
-                    self.var_dict[varname].append("unassigned")
-                self.var_dict[varname].append(str(val))
-            # Existing variable
+            varname = ":".join(self.scope_stack) + ":" + name
+
+            val = self.get_display_value(val, heap_mode)
+            if heap_mode:
+                trace_val = self.encode_heap_value(val, heap_visited)
+                step_value = trace_val
+            elif not self.testing:
+                # The trace value is taken from the live value, as copies of
+                # instances have new ids
+                trace_val = str(val)
+                step_value = copy_step_value(val, memo)
             else:
-                last_val = self.var_dict[varname][-1]
-                for i in range(len(self.var_dict[varname]), self.exec_step_num-1):
-                    self.var_dict[varname].append(last_val)
-                self.var_dict[varname].append(str(val))
+                trace_val = str(val)
+                self.add_var_trace(varname, trace_val)
+            if recorded_locals is not None and name in local_vars:
+                recorded_locals.append((name, trace_val, len(self.current_step["active_vars"])))
+            if step_vars is not None:
+                step_vars.append((name, type(val).__name__, trace_val))
             # Append variable to list for execution step
             var_data = {
                 "var_id" : varname,
                 "var_value" : val,
             }
+            if not self.testing:
+                var_data["step_value"] = step_value
+                var_data["trace_value"] = trace_val
             self.current_step["active_vars"].append(var_data)
 
         # If not testing, process extra line data, such as expressions, in order to show variables
@@ -479,23 +1424,34 @@ class PyInspector(bdb.Bdb):
 
             # Process entry for step in execution
             self.current_step["line_num"] = current_line
+            # Length of the code output (in bytes) before this step is run
+            self.current_step["output_offset"] = self.output_capture.size
             self.current_step["scope"] = self.scope_stack[:] # Copy by value, not reference
+            self.current_step["step_num"] = self.exec_step_num
+            self.current_step["thread"] = self.thread_name
             # TODO: obtain info r.e. what is being returned / assigned / etc.
             self.current_step["data"] = {}
 
+            # Extra line data has been evaluated, so the actual values can now
+            # be swapped for the copies (or heap references) taken above
+            active_vars = self.current_step.pop("active_vars")
             step_copy = copy.deepcopy(self.current_step)
+            step_copy["active_vars"] = [{
+                "var_id" : var_data["var_id"],
+                "var_value" : var_data["step_value"],
+                "trace_value" : var_data["trace_value"],
+            } for var_data in active_vars]
             # Add step to list of steps
-            self.exec_steps.append(step_copy)
+            self.add_exec_step(step_copy, step_vars)
             # Flush current step object
             self.current_step = {}
 
-        # If steps exceeds the max_steps threshold, then exit tracing
-        if self.exec_step_num > MAX_STEPS:
-            self.finished_tracing = True
-            self.add_error("Your code has too many steps (> "+ str(MAX_STEPS) +")", current_line, 1, current_line, 999)
-            # Force quit execution
-            raise bdb.BdbQuit
-            return
+            if recorded_locals is not None:
+                active_vars = step_copy["active_vars"]
+                step_locals = [(name, trace_val, active_vars[i]["var_value"]) for (name, trace_val, i) in recorded_locals]
+                self.record_call_step(step_copy, step_locals)
+
+        self.check_step_limit(current_line)
 
         # Debugging
         self.debug_out.write("CURRENT VAR_DICT:\n" + str(self.var_dict) + "\n")
@@ -503,6 +1459,282 @@ class PyInspector(bdb.Bdb):
         self.debug_out.write("LISTING GLOBAL VARS IN FRAME\n" + str(global_vars) + "\n")
         self.debug_out.write("LISTING LOCAL VARS IN FRAME\n" + str(local_vars) + "\n")
 
+    #============ Call Trace Cache Methods ==============#
+    def get_call_code_info(self, code):
+        if code not in self.call_code_infos:
+            self.call_code_infos[code] = analyse_call_code(code)
+        return self.call_code_infos[code]
+
+    # Returns the extra line data for the given lines in a hashable form, or
+    # None if it cannot be serialised
+    def get_call_line_data(self, line_nums):
+        line_data = [self.extra_line_data[str(n)] for n in line_nums if str(n) in self.extra_line_data]
+        try:
+            return json.dumps(line_data, sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+
+    # Returns a hashable form of the globals read by a function (and by the
+    # functions it calls, including the extra line data for their lines, as
+    # their steps are spliced too), or None if any of them may not be pure
+    def freeze_call_globals(self, global_names, f_globals, visited):
+        items = []
+        for name in sorted(global_names):
+            if name not in f_globals:
+                if name not in PURE_BUILTINS:
+                    return None
+                items.append((name,))
+                continue
+            val = f_globals[name]
+            if isinstance(val, types.FunctionType):
+                # Functions called must be pure too, and defined in the same
+                # namespace
+                if val.func_globals is not f_globals or val.func_closure:
+                    return None
+                info = self.get_call_code_info(val.func_code)
+                defaults = freeze_value(tuple(val.func_defaults or ()))
+                if info is None or defaults is None:
+                    return None
+                if val.func_code in visited:
+                    items.append((name, info[0], defaults))
+                    continue
+                visited.add(val.func_code)
+                line_data = self.get_call_line_data(info[2])
+                func_globals = self.freeze_call_globals(info[1], f_globals, visited)
+                if line_data is None or func_globals is None:
+                    return None
+                items.append((name, info[0], defaults, line_data, func_globals))
+            else:
+                frozen = freeze_value(val)
+                if frozen is None:
+                    return None
+                items.append((name, frozen))
+        return tuple(items)
+
+    # Returns the cache key for the call made in the given frame, or None if
+    # its trace cannot be cached. The key is made of the function's bytecode,
+    # its arguments, the globals it reads, and the extra line data for its
+    # lines (as this is evaluated at each step)
+    def get_call_key(self, frame):
+        if self.call_cache is None or self.testing or self.capture_heap:
+            return None
+        code = frame.f_code
+        info = self.get_call_code_info(code)
+        if info is None:
+            return None
+        (digest, global_names, line_nums) = info
+        args = []
+        for (name, val) in sorted(frame.f_locals.iteritems()):
+            frozen = freeze_value(val)
+            if frozen is None:
+                return None
+            args.append((name, frozen))
+        frozen_globals = self.freeze_call_globals(global_names, frame.f_globals, set([code]))
+        if frozen_globals is None:
+            return None
+        extra_data = self.get_call_line_data(line_nums)
+        if extra_data is None:
+            return None
+        return (digest, tuple(args), frozen_globals, extra_data)
+
+    # Adds a step to the log used to build fragments for the calls being
+    # recorded. {step_locals} holds (name, trace value, value) for each local
+    def record_call_step(self, step, step_locals):
+        self.call_step_log.append({
+            "type" : step["type"],
+            "line_num" : step["line_num"],
+            "scope" : step["scope"],
+            "locals" : step_locals,
+            "extra_line_data" : step["extra_line_data"],
+        })
+
+    # Stores the steps recorded for the innermost call being recorded, which
+    # is returning with {value}
+    def store_call_trace(self, value):
+        recorder = self.call_recorders.pop()
+        base_len = recorder["base_len"]
+        steps = []
+        for step in self.call_step_log[recorder["start"]:]:
+            step = dict(step)
+            # Scope relative to the caller, so it can be spliced at any depth
+            step["scope"] = step["scope"][base_len:]
+            steps.append(step)
+        fragment = {
+            "steps" : copy.deepcopy(steps),
+            "return_repr" : repr(value),
+        }
+        self.call_cache.put(recorder["key"], fragment)
+        if not self.call_recorders:
+            self.call_step_log = []
+
+    def abort_call_recording(self):
+        self.call_recorders = []
+        self.call_step_log = []
+
+    # Adds the steps of a cached call to the trace, as if the call had been
+    # traced. Globals are rendered once, as a pure call cannot change them
+    def splice_call_trace(self, frame, key, fragment):
+        self.metrics["counts"]["call_cache_hits"] += 1
+        self.current_step = {}
+        # Scope of the caller (the function name has already been pushed)
+        self.scope_stack.pop()
+        base_scope = self.scope_stack[:]
+        output_offset = self.output_capture.size
+        global_vars = []
+        memo = {}
+        for (name, val) in self.get_filtered_vars(frame.f_globals).iteritems():
+            val = self.get_display_value(val, False)
+            global_vars.append((name, str(val), copy_step_value(val, memo)))
+
+        compressing = self.compress_calls and not self.testing
+        for (i, step) in enumerate(fragment["steps"]):
+            scope = base_scope + step["scope"]
+            prefix = ":".join(scope) + ":"
+            # Calls within the fragment are added to the call tree as if
+            # traced (the node for the spliced call itself is already started)
+            if compressing and step["type"] == "CALL" and i > 0:
+                args = dict((name, trace_val) for (name, trace_val, val) in step["locals"])
+                self.start_call_node(scope[-1], args, len(scope) - 1)
+
+            self.exec_step_num = next(self.step_counter)
+            self.thread_step_count += 1
+            current_line = step["line_num"]
+            self.lineno = current_line
+
+            local_names = set(name for (name, trace_val, val) in step["locals"])
+            active_vars = []
+            step_locals = []
+            step_vars = []
+            for (name, trace_val, val) in global_vars:
+                # Skip globals shadowed by local variables
+                if name not in local_names:
+                    active_vars.append({
+                        "var_id" : prefix + name,
+                        "var_value" : copy.deepcopy(val),
+                        "trace_value" : trace_val,
+                    })
+                    step_vars.append((name, type(val).__name__, trace_val))
+            for (name, trace_val, val) in step["locals"]:
+                var_value = copy.deepcopy(val)
+                active_vars.append({
+                    "var_id" : prefix + name,
+                    "var_value" : var_value,
+                    "trace_value" : trace_val,
+                })
+                step_locals.append((name, trace_val, var_value))
+                step_vars.append((name, type(val).__name__, trace_val))
+
+            new_step = {
+                "type" : step["type"],
+                "active_vars" : active_vars,
+                "extra_line_data" : copy.deepcopy(step["extra_line_data"]),
+                "line_num" : current_line,
+                "output_offset" : output_offset,
+                "scope" : scope,
+                "step_num" : self.exec_step_num,
+                "thread" : self.thread_name,
+                "data" : {},
+            }
+            self.add_exec_step(new_step, step_vars)
+            self.metrics["counts"]["spliced_steps"] += 1
+            if self.call_recorders:
+                self.record_call_step(new_step, step_locals)
+            if compressing and step["type"] == "RETURN":
+                self.finish_call_node()
+            self.check_step_limit(current_line)
+
+        # The call itself is run untraced, and its return value checked
+        self.spliced_frame = frame
+        self.spliced_key = key
+        self.spliced_fragment = fragment
+
+    # Local trace function for a spliced call, which is run untraced
+    def trace_spliced_call(self, frame, event, arg):
+        if event == "return":
+            if repr(arg) != self.spliced_fragment["return_repr"]:
+                # Should not happen for a pure function, but never reuse it
+                self.call_cache.discard(self.spliced_key)
+                self.debug_out.write("SPLICED CALL RETURNED " + repr(arg) + ", EXPECTED " + self.spliced_fragment["return_repr"] + "\n")
+            self.spliced_frame = None
+            self.spliced_key = None
+            self.spliced_fragment = None
+        return self.trace_spliced_call
+
+    #============ Call Tree Methods ==============#
+    # Starts a node for a call to {func}, with {args} as a dict of argument
+    # names to their trace values, called from a scope of length {depth}
+    def start_call_node(self, func, args, depth):
+        self.call_stack.append({
+            "func" : func,
+            "args" : args,
+            "start" : len(self.exec_steps),
+            "token_start" : len(self.call_tokens),
+            "step_count_start" : self.thread_step_count,
+            "output_offset" : self.output_capture.size,
+            "depth" : depth,
+            "children" : [],
+        })
+
+    # Completes the innermost call node, once its return step has been added.
+    # If an identical call has been stored before, the call's steps are
+    # replaced with a CALL_REF step
+    def finish_call_node(self):
+        node = self.call_stack.pop()
+        base_offset = node["output_offset"]
+        tokens = [(kind, digest, offset - base_offset) for (kind, digest, offset) in self.call_tokens[node["token_start"]:]]
+        signature = hashlib.sha1(repr((node["func"], sorted(node["args"].items()), tokens))).digest()
+        # The call is represented by a single token in its caller
+        del self.call_tokens[node["token_start"]:]
+        if self.call_stack:
+            self.call_tokens.append(("NODE", signature, base_offset))
+        else:
+            self.call_tokens = []
+
+        num_steps = self.thread_step_count - node["step_count_start"]
+        first_step = self.exec_steps[node["start"]]
+        # A call whose steps are interleaved with those of other threads is
+        # neither compressed nor referenced, as its steps could not be
+        # expanded in their global order
+        contiguous = self.exec_step_num - first_step["step_num"] + 1 == num_steps
+        with self.thread_lock:
+            ref_id = self.call_signatures.get(signature) if contiguous else None
+            if ref_id is None:
+                node_id = len(self.call_nodes)
+                self.call_nodes.append({
+                    "func" : node["func"],
+                    "args" : node["args"],
+                    "num_steps" : num_steps,
+                    "start" : node["start"],
+                    "length" : len(self.exec_steps) - node["start"],
+                    "depth" : node["depth"],
+                    "output_offset" : base_offset,
+                    "first_step" : first_step["step_num"],
+                    "thread" : self.thread_name,
+                    "children" : node["children"],
+                })
+                if contiguous:
+                    self.call_signatures[signature] = node_id
+
+        if ref_id is not None:
+            node_id = ref_id
+            del self.exec_steps[node["start"]:]
+            self.exec_steps.append({
+                "type" : "CALL_REF",
+                "node" : node_id,
+                "num_steps" : num_steps,
+                "line_num" : first_step["line_num"],
+                "scope" : first_step["scope"][:node["depth"]],
+                "output_offset" : base_offset,
+                "step_num" : first_step["step_num"],
+                "thread" : self.thread_name,
+            })
+            self.metrics["counts"]["compressed_calls"] += 1
+
+        if self.call_stack:
+            self.call_stack[-1]["children"].append(node_id)
+        else:
+            self.call_tree.append(node_id)
+
     #============ Test Case Methods ==============#
     def get_test_input_assignment(self, input_data):
         input_val = input_data["value"]
@@ -525,7 +1757,72 @@ class PyInspector(bdb.Bdb):
 
         return output_val
 
+    def should_trace_test(self, test_index):
+        if self.trace_tests == "all":
+            return True
+        elif self.trace_tests == "failures":
+            return False
+        return test_index in self.trace_tests
+
+    # Runs the test call without the tracer, only counting steps and
+    # variables. If the test passes, its result is set and the StepCounter is
+    # returned. Otherwise None is returned, and the test should be traced to
+    # give detailed results. If the test returned a wrong value, its result
+    # is kept in {untraced_result}, to be reported by the traced run
+    def run_untraced_test(self, test_call):
+        counter = StepCounter(self.target_func_name)
+        try:
+            value = counter.run(compile(test_call, "<string>", mode="eval"), self.global_vars)
+        except Exception:
+            # Let the traced run report the error
+            return None
+        if counter.exception or counter.exceeded_steps:
+            return None
+        output_data, passed_test = self.check_test_result(value)
+        if not passed_test:
+            self.untraced_result = (output_data, passed_test)
+            return None
+        self.metrics["counts"]["tests_untraced"] += 1
+        self.add_test_result(output_data, passed_test, len(counter.var_names), counter.num_steps)
+        return counter
+
+    # Returns a new namespace in the state of the one shared by the tests
+    # before the current test, by running the code and {test_calls} again
+    # untraced, with the same step limit as when they were first run
+    def get_test_namespace(self, code, test_calls):
+        discard_output = OutputCapture()
+        discard_output.stop()
+        test_namespace = self.get_initial_globals(discard_output)
+        exec_code(code, test_namespace)
+        for test_call in test_calls:
+            try:
+                StepCounter(self.target_func_name).run(compile(test_call, "<string>", mode="eval"), test_namespace)
+            except Exception:
+                pass
+        return test_namespace
+
     def set_test_result(self, value):
+        # A test which failed untraced keeps that result, even if the traced
+        # run differs (e.g. when the code is not deterministic)
+        if self.untraced_result is not None:
+            output_data, passed_test = self.untraced_result
+        else:
+            output_data, passed_test = self.check_test_result(value)
+        self.add_test_result(output_data, passed_test, len(self.var_dict), self.exec_step_num)
+
+    def add_test_result(self, output_data, passed_test, num_vars, num_steps):
+        self.all_tests_passed &= passed_test
+        self.test_results.append({
+            "inputs" : self.current_inputs,
+            "outputs" : output_data,
+            "passed" : passed_test,
+            "num_vars" : num_vars,
+            "num_steps" : num_steps,
+        })
+
+    # Compares the value returned by the test function with the expected
+    # outputs, returning the output data and whether the test passed
+    def check_test_result(self, value):
         output_data = []
         passed_test = True
         if isinstance(value, tuple):
@@ -582,46 +1879,228 @@ class PyInspector(bdb.Bdb):
                 "passed" : this_output_passed,
             })
 
-        self.all_tests_passed &= passed_test
-        self.test_results.append({
-            "inputs" : self.current_inputs,
-            "outputs" : output_data,
-            "passed" : passed_test,
-            "num_vars" : len(self.var_dict),
-            "num_steps" : self.exec_step_num,
-        })
-
-    #============= In-Built Methods ==============#
-    def user_call(self, frame, args):
-        if "__all__" in frame.f_globals:
-            self.set_step()
-            return
-
+        return output_data, passed_test
+
+    #============ Thread Methods ==============#
+    # Called (via trace_new_thread) with the first event of a thread started
+    # by the traced code. Traces the thread with a copy of the inspector
+    def start_thread_trace(self, frame, event, arg):
+        if not self.tracing_threads:
+            sys.settrace(None)
+            return None
+        tracer = copy.copy(self)
+        with self.thread_lock:
+            # Thread names form part of the variable names, so must be unique
+            base_name = threading.current_thread().name.replace(":", "_")
+            names = set([self.thread_name] + [t.thread_name for t in self.thread_tracers])
+            name = base_name
+            suffix = 1
+            while name in names:
+                suffix += 1
+                name = base_name + "-" + str(suffix)
+            tracer.thread_name = name
+            self.thread_tracers.append(tracer)
+        tracer.scope_stack = ["<global>", "<" + name + ">"]
+        tracer.current_step = {}
+        tracer.exec_steps = []
+        tracer.thread_step_count = 0
+        tracer.has_errors = False
+        tracer.stopped_thread = False
+        tracer.trace_lock = threading.Lock()
+        tracer.heap = {}
+        tracer.heap_objects = {}
+        tracer.heap_refs = {}
+        tracer.metrics = {
+            "phases" : self.metrics["phases"],
+            "counts" : dict((event_name, 0) for event_name in EVENT_COUNTS),
+        }
+        tracer.debug_out = StringIO()
+        tracer.call_recorders = []
+        tracer.call_step_log = []
+        tracer.spliced_frame = None
+        tracer.spliced_key = None
+        tracer.spliced_fragment = None
+        tracer.call_stack = []
+        tracer.call_tokens = []
+        sys.settrace(tracer.trace_thread)
+        return tracer.trace_thread(frame, event, arg)
+
+    # Trace function of a thread started by the traced code, dispatching to
+    # the same handlers as the bdb methods below
+    def trace_thread(self, frame, event, arg):
+        if self.stopped_thread or not self.main_tracer.tracing_threads:
+            return None
+        # Held while handling the event, so that merge_thread_steps can wait
+        # for it to finish. Only contended once tracing has ended
+        with self.trace_lock:
+            if not self.main_tracer.tracing_threads:
+                return None
+            try:
+                if event == "call":
+                    # Calls made within a spliced call are not traced
+                    if self.spliced_frame is not None or is_untraced_frame(frame):
+                        return None
+                    self.handle_call(frame)
+                    if frame is self.spliced_frame:
+                        return self.trace_spliced_call
+                elif event == "line":
+                    self.handle_line(frame)
+                elif event == "return":
+                    if frame.f_code.co_name != "<module>":
+                        self.handle_return(frame, arg)
+                elif event == "exception":
+                    # As in the main thread, tracing stops at an exception
+                    self.handle_exception(frame, arg)
+                    self.stopped_thread = True
+                    return None
+            except bdb.BdbQuit:
+                # Too many steps: end the thread, which threading does quietly
+                # for SystemExit
+                self.stopped_thread = True
+                raise SystemExit
+        return self.trace_thread
+
+    # Merges the steps and heaps of all threads into exec_steps and heap, in
+    # their global order. Called once tracing_threads is unset
+    def merge_thread_steps(self):
+        with self.thread_lock:
+            tracers = list(self.thread_tracers)
+        for tracer in tracers:
+            # Wait for any event still being handled in the thread. Later
+            # events are ignored, as tracing_threads is unset
+            tracer.trace_lock.acquire()
+            tracer.trace_lock.release()
+
+        self.steps_by_thread = {self.thread_name : self.exec_steps}
+        for tracer in tracers:
+            self.steps_by_thread[tracer.thread_name] = tracer.exec_steps
+            self.exec_step_num = max(self.exec_step_num, tracer.exec_step_num)
+            self.has_errors = self.has_errors or tracer.has_errors
+            for (event, num) in tracer.metrics["counts"].iteritems():
+                self.metrics["counts"][event] += num
+            self.debug_out.write(tracer.debug_out.getvalue())
+            for (obj_id, versions) in tracer.heap.iteritems():
+                self.heap.setdefault(obj_id, []).extend(versions)
+            tracer.heap_objects = {}
+            tracer.heap_refs = {}
+        if tracers:
+            all_steps = chain(*self.steps_by_thread.values())
+            self.exec_steps = sorted(all_steps, key=lambda step: step["step_num"])
+            # Each thread only adds a version when its own last one differs
+            for (obj_id, versions) in self.heap.iteritems():
+                versions.sort(key=lambda version: version[0])
+                merged = []
+                for version in versions:
+                    if not merged or merged[-1][1] != version[1]:
+                        merged.append(version)
+                self.heap[obj_id] = merged
+
+    #============= Tracing Handlers ==============#
+    # Used by both the bdb methods (main thread) and trace_thread (threads
+    # started by the traced code)
+    def handle_call(self, frame):
         # Push name of function onto scope stack
         self.scope_stack.append(frame.f_code.co_name)
 
         self.current_step["type"] = "CALL"
+        self.metrics["counts"]["calls"] += 1
 
         self.debug_out.write("\n--- FUNCTION CALL ---\n")
+        if self.compress_calls and not self.testing:
+            args = {}
+            for (name, val) in self.get_filtered_vars(frame.f_locals).iteritems():
+                args[name] = str(self.get_display_value(val, False))
+            self.start_call_node(frame.f_code.co_name, args, len(self.scope_stack) - 1)
+        call_key = self.get_call_key(frame)
+        if call_key is not None:
+            fragment = self.call_cache.get(call_key)
+            if fragment is not None:
+                self.splice_call_trace(frame, call_key, fragment)
+                return
+            # Record the call's steps, to be cached when it returns
+            self.metrics["counts"]["call_cache_misses"] += 1
+            self.call_recorders.append({
+                "frame" : frame,
+                "key" : call_key,
+                "start" : len(self.call_step_log),
+                "base_len" : len(self.scope_stack) - 1,
+            })
         self.process_vars(frame)
-        self.set_step() # VERY IMPORTANT!
-
-    def user_line(self, frame):
-        if "__all__" in frame.f_globals:
-            self.set_step()
-            return
 
+    def handle_line(self, frame):
         self.current_step["type"] = "LINE"
+        self.metrics["counts"]["lines"] += 1
 
         self.debug_out.write("\n------- LINE --------\n")
         # Maybe stack would be useful inside functions?
         #stack, curindx = self.get_stack(frame, None)
         self.process_vars(frame)
+
+    def handle_return(self, frame, value):
+        name = frame.f_code.co_name or "<unknown>"
+
+        # Pop head from scope stack
+        self.scope_stack.pop()
+
+        self.current_step["type"] = "RETURN"
+        self.metrics["counts"]["returns"] += 1
+
+        self.debug_out.write("\n----- RETURNING -----\n")
+        self.debug_out.write("RETURNING FROM FUNCTION: " + str(name) + "\nWITH VALUE: " + str(value) + "\n")
+        self.process_vars(frame)
+
+        if self.call_recorders and self.call_recorders[-1]["frame"] is frame:
+            self.store_call_trace(value)
+        if self.call_stack:
+            self.finish_call_node()
+
+    def handle_exception(self, frame, exception_info):
+        name = frame.f_code.co_name or "<unknown>"
+
+        # Add error to list of errors
+        ex_type, err_text, traceback_obj = exception_info
+        err_line = frame.f_lineno
+        self.add_error(err_text, err_line, 1, err_line, 999)
+
+        self.current_step["type"] = "EXCEPTION"
+        self.metrics["counts"]["exceptions"] += 1
+        # Calls which raise are not cached
+        self.abort_call_recording()
+
+        # Debugging
+        self.debug_out.write("\n----- EXCEPTION -----\n")
+        self.debug_out.write("EXCEPTION FOUND IN: " + str(name) + "\nWITH: " + str(exception_info) + "\n")
+        self.process_vars(frame)
+
+    #============= In-Built Methods ==============#
+    def dispatch_call(self, frame, arg):
+        # Calls made within a spliced call are not traced
+        if self.spliced_frame is not None:
+            return None
+        trace_function = bdb.Bdb.dispatch_call(self, frame, arg)
+        if frame is self.spliced_frame:
+            return self.trace_spliced_call
+        return trace_function
+
+    def user_call(self, frame, args):
+        if is_untraced_frame(frame):
+            self.set_step()
+            return
+
+        self.handle_call(frame)
+        self.set_step() # VERY IMPORTANT!
+
+    def user_line(self, frame):
+        if is_untraced_frame(frame):
+            self.set_step()
+            return
+
+        self.handle_line(frame)
         # Continue to next line of code
         self.set_step() # VERY IMPORTANT!
 
     def user_return(self, frame, value):
-        if "__all__" in frame.f_globals:
+        if is_untraced_frame(frame):
             self.set_step()
             return
 
@@ -632,14 +2111,7 @@ class PyInspector(bdb.Bdb):
             self.set_continue()
             return
 
-        # Pop head from scope stack
-        self.scope_stack.pop()
-
-        self.current_step["type"] = "RETURN"
-
-        self.debug_out.write("\n----- RETURNING -----\n")
-        self.debug_out.write("RETURNING FROM FUNCTION: " + str(name) + "\nWITH VALUE: " + str(value) + "\n")
-        self.process_vars(frame)
+        self.handle_return(frame, value)
 
         # If returning from test input function and in test_mode, set value
         # Checking if the calling frame's code object is not nested
@@ -652,23 +2124,11 @@ class PyInspector(bdb.Bdb):
         self.set_step() # VERY IMPORTANT!
 
     def user_exception(self, frame, exception_info):
-        if "__all__" in frame.f_globals:
+        if is_untraced_frame(frame):
             self.set_step()
             return
 
-        name = frame.f_code.co_name or "<unknown>"
-
-        # Add error to list of errors
-        ex_type, err_text, traceback_obj = exception_info
-        err_line = frame.f_lineno
-        self.add_error(err_text, err_line, 1, err_line, 999)
-
-        self.current_step["type"] = "EXCEPTION"
-
-        # Debugging
-        self.debug_out.write("\n----- EXCEPTION -----\n")
-        self.debug_out.write("EXCEPTION FOUND IN: " + str(name) + "\nWITH: " + str(exception_info) + "\n")
-        self.process_vars(frame)
+        self.handle_exception(frame, exception_info)
         self.set_continue() # VERY IMPORTANT!
 
 def test(filepath):
@@ -700,6 +2160,9 @@ def test(filepath):
     print("Execution time:\t\t\t" + str(time_taken) + " milliseconds")
     print("Number of steps in execution:\t" + str(len(exec_steps)))
     print("Number of variables used:\t" + str(len(trace_history)))
+    for phase in PHASES:
+        if phase in dbg.metrics["phases"]:
+            print("Phase '" + phase + "':\t\t" + str(dbg.metrics["phases"][phase] * 1000) + " milliseconds")
     #print(dbg.debug_out.getvalue())
 
 if __name__ == "__main__":